@@ -3,6 +3,9 @@ import sys
 import getpass
 import json
 import logging
+# pylint: disable=W0403
+import containers
+import ports
 from navlib import navlib
 from pyutils import utils
 from pyutils import loggerinitializer
@@ -39,10 +42,14 @@ for jsn in json_list:
     logging.info('container stopped')
 
     # Stop and disable the service
-    utils.stop_disable_service(data['dservice'].split('.')[0])
-    logging.info('service disabled')
+    containers.stop_dservice(data['dservice'].split('.')[0])
+    logging.info('service stopped')
 
-    # Remove service
+    # Records without a driver predate it being configurable
+    containers.cleanup_storage(data['docker_lib'], data.get('storage_driver', 'devicemapper'))
+    logging.info('storage driver cleaned up')
+
+    # Remove service env file (or legacy unit file)
     cmdlist = ['rm', '-rf', data['dservice_path']]
     utils.simple_popen(cmdlist)
     logging.info('service removed')
@@ -88,6 +95,7 @@ for jsn in json_list:
     logging.info('bridge deleted')
 
     utils.remove_firewall(data['port'])
+    ports.release(data['port'])
     logging.info('Port removed')
 
     json_file.close()
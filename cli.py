@@ -8,6 +8,8 @@ from time import sleep
 
 # pylint: disable=W0403
 import containers
+import ports
+import prereqs
 # Import submodules
 from navlib import navlib
 from pyutils import utils, loggerinitializer
@@ -16,17 +18,7 @@ from pyutils import utils, loggerinitializer
 # Globals
 LOG_PATH = '/var/log/murron'
 JSON_PATH = './json'
-try:
-    os.mkdir(LOG_PATH)
-except OSError:
-    # Dir already exists
-    pass
-
-try:
-    os.mkdir(JSON_PATH)
-except OSError:
-    # Dir already exists
-    pass
+prereqs.ensure_dir(LOG_PATH)
 
 CLI_LOG = os.path.join(LOG_PATH, 'cli.log')
 loggerinitializer.initialize_logger(CLI_LOG)
@@ -69,20 +61,29 @@ def setup_vnc(rand_int, navpass, navlog):
     vncpass = set_vnc_passwd()
 
     logging.info('Initializing DockerVNC instance')
-    vnc = containers.DockerVNC(rand_int, navpass, navlog, vncpass)
+    try:
+        vnc = containers.DockerVNC(rand_int, navpass, navlog, vncpass)
+    except SystemExit:
+        # Setup already logged why; give back what was reserved
+        ports.release_tenant(rand_int)
+        raise
 
     logging.info('Starting dockerd')
-    utils.start_enable_service(vnc.docker_service_name)
+    containers.start_dservice(vnc.docker_service_name)
     sleep(5) # Wait for dockerd to start
 
+    logging.info('Opening firewall port')
+    utils.set_firewall(vnc.port)
+
     logging.info('Starting VNC container')
     port = vnc.run()
-    text = 'VNC container started on port: %s' % str(port)
-    logging.info(text)
-
-    logging.info('Opening firewall port')
-    utils.set_firewall(port)
+    if port is None:
+        logging.error('VNC container failed to start')
+    else:
+        text = 'VNC container started on port: %s' % str(port)
+        logging.info(text)
 
+    prereqs.ensure_dir(JSON_PATH)
     json_file = os.path.join(JSON_PATH, vnc.docker_service_name + '_cleanup.json')
 
     data = {'container': 'docker-vnc', 'docker': vnc.docker,
@@ -90,8 +91,9 @@ def setup_vnc(rand_int, navpass, navlog):
             'docker_lib': vnc.docker_lib, 'docker_run': vnc.docker_run,
             'mount_point': vnc.mount, 'dockerd': vnc.dockerd,
             'docker_bridge': vnc.bridge, 'category': vnc.category,
-            'port': port, 'loop_file': vnc.loop_file,
-            'dservice_path': vnc.docker_service_full_path}
+            'port': vnc.port, 'loop_file': vnc.loop_file,
+            'dservice_path': vnc.docker_service_env,
+            'storage_driver': vnc.storage_driver}
 
     output = open(json_file, 'w')
     json.dump(data, output)
@@ -99,27 +101,40 @@ def setup_vnc(rand_int, navpass, navlog):
     logging.info(text)
     output.close()
 
+    if port is None:
+        logging.error('Run cleanup.py to remove the failed setup')
+        sys.exit(1)
+
 
 def setup_jabber(rand_int, navpass, navlog):
     """ Does the setup and starting of Jabber container """
     jabber_ip, user1, pass1, user2, pass2 = set_jabber_vars()
 
     logging.info('Initializing DockerJabber instance')
-    jabber = containers.DockerJabber(rand_int, navpass, navlog, jabber_ip,
-                                     user1, pass1, user2, pass2)
+    try:
+        jabber = containers.DockerJabber(rand_int, navpass, navlog, jabber_ip,
+                                         user1, pass1, user2, pass2)
+    except SystemExit:
+        # Setup already logged why; give back what was reserved
+        ports.release_tenant(rand_int)
+        raise
 
     logging.info('Starting dockerd')
-    utils.start_enable_service(jabber.docker_service_name)
+    containers.start_dservice(jabber.docker_service_name)
     sleep(5) # Wait for dockerd to start
 
+    logging.info('Opening firewall port')
+    utils.set_firewall(jabber.port)
+
     logging.info('Starting jabber container')
     port = jabber.run()
-    text = 'Jabber Container started on port: %s' % str(port)
-    logging.info(text)
-
-    logging.info('Opening firewall port')
-    utils.set_firewall(port)
+    if port is None:
+        logging.error('Jabber container failed to start')
+    else:
+        text = 'Jabber Container started on port: %s' % str(port)
+        logging.info(text)
 
+    prereqs.ensure_dir(JSON_PATH)
     json_file = os.path.join(JSON_PATH, jabber.docker_service_name + '_cleanup.json')
 
     data = {'container': 'docker-jabber', 'docker': jabber.docker,
@@ -127,8 +142,9 @@ def setup_jabber(rand_int, navpass, navlog):
             'docker_lib': jabber.docker_lib, 'docker_run': jabber.docker_run,
             'mount_point': jabber.mount, 'dockerd': jabber.dockerd,
             'docker_bridge': jabber.bridge, 'category': jabber.category,
-            'port': port, 'loop_file': jabber.loop_file,
-            'dservice_path': jabber.docker_service_full_path}
+            'port': jabber.port, 'loop_file': jabber.loop_file,
+            'dservice_path': jabber.docker_service_env,
+            'storage_driver': jabber.storage_driver}
 
     output = open(json_file, 'w')
     json.dump(data, output)
@@ -136,6 +152,10 @@ def setup_jabber(rand_int, navpass, navlog):
     logging.info(text)
     output.close()
 
+    if port is None:
+        logging.error('Run cleanup.py to remove the failed setup')
+        sys.exit(1)
+
 
 def main():
     """ Main function """
@@ -167,12 +187,7 @@ def main():
         sys.exit(1)
 
     num_loops = 20
-    utils.create_loop_devices(num_loops)
-    text = 'Created %d loop devices' % num_loops
-    logging.info(text)
-
-    logging.info('Setting firewall to masquerade on public zone')
-    utils.set_masquerade()
+    prereqs.ensure_prereqs(num_loops)
 
     logging.info('Prereqs complete')
 
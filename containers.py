@@ -1,38 +1,187 @@
 """ Module which contains container classes """
 
+import os
 import sys
 import logging
 import netifaces  # Need to pip install netifaces
 
 # Import submodules
 # pylint: disable=W0403
+import ports
+import prereqs
 from pyutils import utils
 from navlib import navlib
 
 # Globals
 BRIDGE_IPS = ['172.18.1.1', '172.18.2.1', '172.18.3.1', '172.18.4.1',
               '172.18.5.1', '172.18.6.1', '172.18.7.1', '172.18.8.1']
+DSERVICE_TEMPLATE = 'murron-docker'
+ENV_PATH = '/etc/murron'
+LOOP_SIZE_MB = 2048
+STORAGE_DRIVERS = ['overlay2', 'vfs', 'devicemapper']
+# Loop devices a tenant uses: the navencrypt volume, plus data and
+# metadata for loopback devicemapper
+DRIVER_LOOPS = {'overlay2': 1, 'vfs': 1, 'devicemapper': 3}
+# Filesystem types (stat -f) overlay2 can use as its backing filesystem
+OVERLAY2_BACKING_FS = ['ext2/ext3', 'xfs']
+
+
+def used_bridge_ips():
+    """ Returns the bridge IPs already assigned to docker devices """
+    cmdlist = ['cat', '/proc/net/dev']
+    # pylint: disable=W0612
+    output, errors = utils.simple_popen(cmdlist)
+
+    tmp = output.split()
+    docker_dev = []
+    for item in tmp:
+        if 'docker' in item:
+            docker_dev.append(item.rstrip(':'))
+
+    used_ips = []
+    for dev in docker_dev:
+        used_ips.append(netifaces.ifaddresses(dev)[2][0]['addr'])
+
+    return used_ips
+
+
+def env_file_path(tenant):
+    """ Returns the path of the tenant's murron-docker@ env file """
+    return os.path.join(ENV_PATH, 'docker-%s.env' % tenant)
+
+
+def tenant_exists(tenant):
+    """ True if the tenant got as far as writing its env file """
+    return os.path.exists(env_file_path(tenant))
+
+
+def start_dservice(name):
+    """ Starts a murron-docker@ instance. Instances are not enabled, so
+        nothing reloads systemd and nothing autostarts before navencrypt
+        is unlocked at boot """
+    utils.simple_popen(['systemctl', 'start', name])
+
+
+def stop_dservice(name):
+    """ Stops a murron-docker@ instance, or stops and disables a
+        per-tenant unit file created before the template existed """
+    if name.startswith(DSERVICE_TEMPLATE + '@'):
+        utils.simple_popen(['systemctl', 'stop', name])
+    else:
+        utils.stop_disable_service(name)
+
+
+def overlay2_supported(path):
+    """ True if the kernel has overlay and the filesystem under path can
+        back overlay2 (ext4, or xfs formatted with ftype=1) """
+    utils.simple_popen(['modprobe', 'overlay'])
+    with open('/proc/filesystems', 'r') as filesystems:
+        if 'overlay' not in filesystems.read().split():
+            return False
+
+    real_path = os.path.realpath(path)
+    # pylint: disable=W0612
+    output, errors = utils.simple_popen(['stat', '-f', '-c', '%T', real_path])
+    fs_type = output.strip()
+    if fs_type not in OVERLAY2_BACKING_FS:
+        return False
+
+    if fs_type == 'xfs':
+        output, errors = utils.simple_popen(['xfs_info', real_path])
+        return 'ftype=1' in output
+
+    return True
+
+
+def cleanup_storage(docker_lib, storage_driver):
+    """ Releases what the storage driver left behind under docker_lib once
+        the daemon is stopped, so the lib dir and mount can be removed """
+    real_lib = os.path.realpath(docker_lib)
+
+    # Leftover overlay/devicemapper container mounts, deepest first
+    with open('/proc/mounts', 'r') as mounts:
+        mount_points = [line.split()[1] for line in mounts
+                        if line.split()[1].startswith(real_lib + '/')]
+    for mount_point in sorted(mount_points, reverse=True):
+        utils.simple_popen(['umount', '-l', mount_point])
+        text = 'Unmounted %s' % mount_point
+        logging.info(text)
+
+    if storage_driver != 'devicemapper':
+        return
+
+    # Loopback devicemapper: thin devices, then the pool, then its loops
+    dm_root = os.path.join(real_lib, 'devicemapper')
+    try:
+        stat = os.stat(dm_root)
+    except OSError:
+        return
+
+    pool_prefix = 'docker-%d:%d-%d-' % (os.major(stat.st_dev), os.minor(stat.st_dev),
+                                        stat.st_ino)
+    # pylint: disable=W0612
+    output, errors = utils.simple_popen(['dmsetup', 'ls'])
+    devices = [line.split()[0] for line in output.splitlines()
+               if line.startswith(pool_prefix)]
+    for device in sorted(devices, key=lambda device: device.endswith('-pool')):
+        utils.simple_popen(['dmsetup', 'remove', device])
+        text = 'Removed device mapper device %s' % device
+        logging.info(text)
+
+    for loop_file in ['data', 'metadata']:
+        loop_path = os.path.join(dm_root, 'devicemapper', loop_file)
+        output, errors = utils.simple_popen(['losetup', '-j', loop_path])
+        for line in output.splitlines():
+            utils.simple_popen(['losetup', '-d', line.split(':')[0]])
+            text = 'Detached %s from %s' % (line.split(':')[0], loop_path)
+            logging.info(text)
+
 
 # pylint: disable=R0902
 class ContainerBase(object):
     """ Base class for docker nav containers """
-    def __init__(self, rand_int, navpass, navlogfile=sys.stdout):
+    # Per-image default, overridden per request
+    STORAGE_DRIVER = 'overlay2'
+
+    def __init__(self, rand_int, navpass, navlogfile=sys.stdout, storage_driver=None):
+        # Checked before anything is created, nothing to undo
+        if storage_driver is not None and storage_driver not in STORAGE_DRIVERS:
+            text = 'Unsupported storage driver: %s' % storage_driver
+            logging.error(text)
+            sys.exit(1)
+
         self.rand_int = rand_int
         self.navpass = navpass
+        self.port = self.reserve_port()
         self.docker_lib = self.create_lib()
         self.docker_run = self.create_run()
         self.loop_file = self.create_loop()
         self.mount = self.create_mount()
         self.dockerd = self.create_dockerd()
         self.bridge = self.create_bridge()
-        self.docker_service_full_path = self.create_dservice()
-        self.docker_service_name = self.get_dservice_name()
         self.docker = '/usr/bin/docker -H unix://%s/docker.sock' % self.docker_lib
         self.navlogfile = navlogfile
 
         # Navencrypt setup
         self.device, self.category = self.run_nav()
 
+        # Storage driver is checked against the encrypted mount, so after nav
+        self.storage_driver = self.select_storage_driver(storage_driver or
+                                                         self.STORAGE_DRIVER)
+        self.docker_service_env = self.create_dservice()
+        self.docker_service_name = self.get_dservice_name()
+
+    def reserve_port(self):
+        """ Reserves the host port the container will be published on """
+        ports.sweep(tenant_exists)
+        port = ports.reserve(self.rand_int)
+
+        if port is None:
+            logging.error('Could not reserve a host port')
+            sys.exit(1)
+
+        return port
+
     def create_lib(self):
         """ Creates the docker lib directory """
         lib = '/dmcrypt/lib/docker-%s' % self.rand_int
@@ -58,7 +207,8 @@ class ContainerBase(object):
     def create_loop(self):
         """ Creates the 2G loop file for navencrypt prepare """
         loop_file = '/dmcrypt/docker-%s-loop' % self.rand_int
-        cmdlist = ['dd', 'if=/dev/zero', 'of=%s' % loop_file, 'bs=1M', 'count=2048']
+        cmdlist = ['dd', 'if=/dev/zero', 'of=%s' % loop_file, 'bs=1M',
+                   'count=%d' % LOOP_SIZE_MB]
         utils.simple_popen(cmdlist)
 
         text = 'Created loop file: %s' % loop_file
@@ -91,19 +241,7 @@ class ContainerBase(object):
     def create_bridge(self):
         """ Creates a bridge for the docker daemon """
         # First get an available IP
-        cmdlist = ['cat', '/proc/net/dev']
-        # pylint: disable=W0612
-        output, errors = utils.simple_popen(cmdlist)
-
-        tmp = output.split()
-        docker_dev = []
-        for item in tmp:
-            if 'docker' in item:
-                docker_dev.append(item.rstrip(':'))
-
-        used_ips = []
-        for dev in docker_dev:
-            used_ips.append(netifaces.ifaddresses(dev)[2][0]['addr'])
+        used_ips = used_bridge_ips()
 
         for avail_ip in BRIDGE_IPS:
             if avail_ip not in used_ips:
@@ -127,39 +265,47 @@ class ContainerBase(object):
 
         return docker_bridge
 
-    def create_dservice(self):
-        """ Copies /usr/lib/systemd/system/docker.service
-            and modifies for new dockerd """
-        # Copy docker service file to new docker service file
-        docker_service = '/usr/lib/systemd/system/docker.service'
-        new_docker_service = '/usr/lib/systemd/system/docker%s.service' % self.rand_int
-        cmdlist = ['cp', docker_service, new_docker_service]
-        utils.simple_popen(cmdlist)
+    def select_storage_driver(self, requested):
+        """ Returns the storage driver to use, falling back to vfs when the
+            encrypted mount cannot back overlay2 """
+        if requested == 'overlay2' and not overlay2_supported(self.docker_lib):
+            text = 'overlay2 not supported on %s, falling back to vfs' % self.docker_lib
+            logging.warning(text)
+            return 'vfs'
 
-        # Modify new docker service file
-        dockerd_cmd = 'ExecStart=%s '\
-                      '-D --bridge=%s '\
-                      '--exec-root=%s '\
-                      '-g %s '\
-                      '-H unix://%s/docker.sock '\
-                      '-p %s/docker.pid '\
-                      '--storage-driver=devicemapper '\
-                      '--iptables=false --ip-masq=false' % (self.dockerd, self.bridge,
-                                                            self.docker_run, self.docker_lib,
-                                                            self.docker_lib, self.docker_run)
-
-        old = 'ExecStart=/usr/bin/dockerd'
-        new = dockerd_cmd
-        utils.change_file(new_docker_service, old, new)
-
-        text = 'Created docker service file: %s' % new_docker_service
+        text = 'Using storage driver: %s' % requested
+        logging.info(text)
+
+        return requested
+
+    def create_dservice(self):
+        """ Writes the environment file for this murron-docker@ instance """
+        prereqs.ensure_dir(ENV_PATH)
+        env_file = env_file_path(self.rand_int)
+
+        env = 'DOCKERD=%s\n'\
+              'BRIDGE=%s\n'\
+              'EXEC_ROOT=%s\n'\
+              'GRAPH=%s\n'\
+              'SOCKET=%s/docker.sock\n'\
+              'PIDFILE=%s/docker.pid\n'\
+              'STORAGE_DRIVER=%s\n' % (self.dockerd, self.bridge,
+                                        self.docker_run, self.docker_lib,
+                                        self.docker_lib, self.docker_run,
+                                        self.storage_driver)
+
+        output = open(env_file, 'w')
+        output.write(env)
+        output.close()
+
+        text = 'Created docker service env file: %s' % env_file
         logging.info(text)
 
-        return new_docker_service
+        return env_file
 
     def get_dservice_name(self):
         """ Get the service name for starting and stopping service """
-        return self.docker_service_full_path.split('/')[5].split('.')[0]
+        return '%s@%s' % (DSERVICE_TEMPLATE, self.rand_int)
 
     def run_nav(self):
         """ Sets up navencrypt items """
@@ -204,40 +350,37 @@ class ContainerBase(object):
 
 class DockerVNC(ContainerBase):
     """ Class for wallace123/docker-vnc containers """
-    def __init__(self, rand_int, navpass, navlogfile, vncpass):
-        ContainerBase.__init__(self, rand_int, navpass, navlogfile)
+    def __init__(self, rand_int, navpass, navlogfile, vncpass, storage_driver=None):
+        ContainerBase.__init__(self, rand_int, navpass, navlogfile, storage_driver)
         self.vncpass = vncpass
 
     def run(self):
-        """ Starts the container, returns the port it started on """
+        """ Starts the container, returns the port it started on or None """
         # Start the container
-        docker_cmd = '%s run -d -p 5900 --name docker-vnc '\
+        docker_cmd = '%s run -d -p %d:5900 --name docker-vnc '\
                      '-e VNCPASS=%s '\
                      '-v /etc/hosts:/etc/hosts:ro '\
                      '-v /etc/resolv.conf:/etc/resolv.conf:ro '\
-                     'wallace123/docker-vnc' % (self.docker, self.vncpass)
+                     'wallace123/docker-vnc' % (self.docker, self.port, self.vncpass)
 
         cmdlist = docker_cmd.split()
-        utils.simple_popen(cmdlist)
-
-        # Get the port
-        docker_cmd = '%s port docker-vnc' % self.docker
-        cmdlist = docker_cmd.split()
-        # pylint: disable=W0612
         output, errors = utils.simple_popen(cmdlist)
 
-        port_output = output.split(':')
-        port = port_output[1].rstrip()
+        # docker run -d prints the container id when it started
+        if not output.strip():
+            text = 'docker run failed: %s' % errors.strip()
+            logging.error(text)
+            return None
 
-        return port
+        return self.port
 
 
 class DockerJabber(ContainerBase):
     """ Class for wallace123/docker-jabber containers """
     # pylint: disable=R0913
     def __init__(self, rand_int, navpass, navlogfile,
-                 jabber_ip, user1, pass1, user2, pass2):
-        ContainerBase.__init__(self, rand_int, navpass, navlogfile)
+                 jabber_ip, user1, pass1, user2, pass2, storage_driver=None):
+        ContainerBase.__init__(self, rand_int, navpass, navlogfile, storage_driver)
         self.jabber_ip = jabber_ip
         self.user1 = user1
         self.pass1 = pass1
@@ -245,24 +388,21 @@ class DockerJabber(ContainerBase):
         self.pass2 = pass2
 
     def run(self):
-        """ Starts the container, returns the port it started on """
+        """ Starts the container, returns the port it started on or None """
         # Start the container
-        docker_cmd = '%s run -d -p 5222 --name docker-jabber -e JHOST=%s -e USER1=%s '\
+        docker_cmd = '%s run -d -p %d:5222 --name docker-jabber -e JHOST=%s -e USER1=%s '\
                      '-e PASS1=%s -e USER2=%s -e PASS2=%s '\
-                     'wallace123/docker-jabber' % (self.docker, self.jabber_ip,
+                     'wallace123/docker-jabber' % (self.docker, self.port, self.jabber_ip,
                                                    self.user1, self.pass1,
                                                    self.user2, self.pass2)
 
         cmdlist = docker_cmd.split()
-        utils.simple_popen(cmdlist)
-
-        # Get the port
-        docker_cmd = '%s port docker-jabber' % self.docker
-        cmdlist = docker_cmd.split()
-        # pylint: disable=W0612
         output, errors = utils.simple_popen(cmdlist)
 
-        port_output = output.split(':')
-        port = port_output[1].rstrip()
+        # docker run -d prints the container id when it started
+        if not output.strip():
+            text = 'docker run failed: %s' % errors.strip()
+            logging.error(text)
+            return None
 
-        return port
+        return self.port
@@ -0,0 +1,374 @@
+""" Front-end speaking the navlistener protocol that places containers
+    across several navlistener hosts """
+
+import os
+import sys
+import json
+import socket
+import logging
+import threading
+import SocketServer
+from time import sleep, time
+
+# pylint: disable=W0403
+import prereqs
+# Import submodules
+from pyutils import loggerinitializer
+
+# Globals
+LOG_PATH = '/var/log/murron'
+prereqs.ensure_dir(LOG_PATH)
+
+COORDINATOR_LOG = os.path.join(LOG_PATH, 'coordinator.log')
+loggerinitializer.initialize_logger(COORDINATOR_LOG)
+CAPACITY_INTERVAL = 10  # Seconds between capacity polls of each backend
+RECV_SIZE = 4096
+
+
+# Global functions
+def recv_json(sock):
+    """ Reads from the socket until a full JSON document or EOF,
+        returns the raw string """
+    data = ''
+    while True:
+        chunk = sock.recv(RECV_SIZE)
+        if not chunk:
+            return data
+        data += chunk
+        try:
+            json.loads(data)
+            return data
+        except ValueError:
+            continue
+
+
+def tenant_id(data_dict):
+    """ Returns the tenant id from a start request or cleanup record """
+    if 'rand_int' in data_dict:
+        return str(data_dict['rand_int'])
+
+    return data_dict.get('dservice', '').split('@')[-1].split('.')[0]
+
+
+class Backend(object):
+    """ A navlistener instance and its last capacity report """
+    def __init__(self, address, lock):
+        host, port = address.rsplit(':', 1)
+        self.address = address
+        self.host = host
+        self.port = int(port)
+        self.lock = lock
+        self.capacity = None
+        # Tenants we dispatched that are still starting, and ones that
+        # finished after the last poll was sent, which it may not count
+        self.pending = set()
+        self.completed = {}
+
+    def request(self, data_dict):
+        """ Sends a request to the listener, returns its raw response """
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            sock.sendall(json.dumps(data_dict))
+            return recv_json(sock)
+        finally:
+            sock.close()
+
+    def refresh(self):
+        """ Polls the listener for a capacity report """
+        sent = time()
+        try:
+            report = json.loads(self.request({'action': 'capacity'}))
+        except (socket.error, ValueError):
+            text = 'Backend %s did not report capacity' % self.address
+            logging.error(text)
+            with self.lock:
+                self.capacity = None
+            return
+
+        with self.lock:
+            self.capacity = report
+            # Starts that finished before the poll are in the report
+            self.completed = dict((tenant, done) for tenant, done in self.completed.items()
+                                  if done >= sent)
+
+    def unreported(self):
+        """ Tenants we dispatched whose resources the report may not show
+            yet. The report's own in-flight starts are already taken out
+            of its free resources and are not counted again """
+        return self.pending | set(self.completed)
+
+    def tenant_loops(self, data_dict):
+        """ Loop devices the start will use, given its storage driver """
+        driver = data_dict.get('storage_driver') or self.capacity['default_driver']
+        loops = self.capacity['tenant_loops']
+        return loops.get(driver, max(loops.values()))
+
+    def fits(self, data_dict, unreported):
+        """ True if the last report leaves room for this start, given the
+            number of unreported starts on this host. Call with the lock held """
+        cap = self.capacity
+        if cap is None:
+            return False
+
+        used_loops = unreported * max(cap['tenant_loops'].values())
+        return cap['free_bridges'] - unreported > 0 and \
+            cap['free_loops'] - used_loops >= self.tenant_loops(data_dict) and \
+            cap['free_ports'] - unreported > 0 and \
+            cap['disk_free_mb'] - unreported * cap['tenant_disk_mb'] >= cap['tenant_disk_mb']
+
+    def load(self, unreported):
+        """ Number of tenants on this host, running or on their way. Call
+            with the lock held """
+        return self.capacity['tenants'] + unreported
+
+    def finished(self, tenant, started):
+        """ Records the end of a dispatched start """
+        with self.lock:
+            self.pending.discard(tenant)
+            if started:
+                self.completed[tenant] = time()
+
+
+class Coordinator(object):
+    """ Places starts on the least-loaded backend and routes the rest """
+    def __init__(self, backends):
+        self.lock = threading.Lock()
+        self.backends = dict((address, Backend(address, self.lock)) for address in backends)
+        self.owners = {}
+
+    def poll(self):
+        """ Refreshes backend capacity forever """
+        while True:
+            for backend in self.backends.values():
+                backend.refresh()
+            sleep(CAPACITY_INTERVAL)
+
+    def host_unreported(self, backend):
+        """ Unreported starts across every listener sharing the backend's
+            host, which all draw on the same resources. Call with the lock held """
+        tenants = set()
+        for other in self.backends.values():
+            if other.capacity is not None and \
+                    other.capacity['host_id'] == backend.capacity['host_id']:
+                tenants |= other.unreported()
+
+        return len(tenants)
+
+    def place(self, data_dict):
+        """ Picks the least-loaded backend that fits and counts the start
+            against it, None if no backend fits """
+        with self.lock:
+            candidates = []
+            for backend in self.backends.values():
+                if backend.capacity is None:
+                    continue
+                unreported = self.host_unreported(backend)
+                if backend.fits(data_dict, unreported):
+                    candidates.append((backend.load(unreported), backend))
+
+            if not candidates:
+                return None
+
+            backend = min(candidates, key=lambda candidate: candidate[0])[1]
+            backend.pending.add(tenant_id(data_dict))
+            return backend
+
+    def find_owner(self, tenant):
+        """ Returns the backend running the tenant, asking each if unknown """
+        if tenant in self.owners:
+            return self.backends.get(self.owners[tenant])
+
+        for backend in self.backends.values():
+            try:
+                response = backend.request({'action': 'status', 'rand_int': tenant})
+                json.loads(response)
+            except (socket.error, ValueError):
+                continue
+
+            self.owners[tenant] = backend.address
+            return backend
+
+        return None
+
+    def place_start(self, data_dict):
+        """ Starts a container on the placed backend, returns the cleanup
+            record or an error string """
+        tenant = tenant_id(data_dict)
+        backend = self.place(data_dict)
+        if backend is None:
+            logging.error('No backend has capacity for start')
+            return 'No backend has capacity'
+
+        text = 'Placing %s on %s' % (tenant, backend.address)
+        logging.info(text)
+
+        try:
+            response = backend.request(data_dict)
+        except socket.error:
+            backend.finished(tenant, False)
+            text = 'Backend %s failed start' % backend.address
+            logging.error(text)
+            return text
+
+        try:
+            record = json.loads(response)
+        except ValueError:
+            backend.finished(tenant, False)
+            return response
+
+        backend.finished(tenant, True)
+        record['listener'] = backend.address
+        self.owners[tenant] = backend.address
+
+        return record
+
+    def start(self, data_dict):
+        """ Starts one container, returns the response for the client """
+        result = self.place_start(data_dict)
+        if isinstance(result, dict):
+            return json.dumps(result)
+
+        return result
+
+    def batch(self, data_dict):
+        """ Fans out a list of start requests across backends, returns a
+            list of cleanup records and error strings """
+        requests = data_dict['requests']
+        responses = [None] * len(requests)
+
+        def run(pos):
+            """ Runs one start of the batch """
+            responses[pos] = self.place_start(requests[pos])
+
+        threads = [threading.Thread(target=run, args=(pos,)) for pos in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return json.dumps(responses)
+
+    def stop(self, data_dict):
+        """ Routes a cleanup to the backend that owns the tenant """
+        tenant = tenant_id(data_dict)
+        if data_dict.get('listener') in self.backends:
+            backend = self.backends[data_dict['listener']]
+        else:
+            backend = self.find_owner(tenant)
+
+        if backend is None:
+            text = 'No backend owns tenant %s' % tenant
+            logging.error(text)
+            return text
+
+        try:
+            response = backend.request(data_dict)
+        except socket.error:
+            text = 'Backend %s failed stop' % backend.address
+            logging.error(text)
+            return text
+
+        self.owners.pop(tenant, None)
+
+        return response
+
+    def status(self, data_dict):
+        """ Returns the tenant status from its owning backend """
+        backend = self.find_owner(tenant_id(data_dict))
+        if backend is None:
+            return 'Unknown tenant: %s' % tenant_id(data_dict)
+
+        try:
+            return backend.request(data_dict)
+        except socket.error:
+            text = 'Backend %s failed status' % backend.address
+            logging.error(text)
+            return text
+
+    def list(self):
+        """ Returns every backend's tenants, tagged with the listener """
+        tenants = []
+        for backend in self.backends.values():
+            try:
+                records = json.loads(backend.request({'action': 'list'}))
+            except (socket.error, ValueError):
+                continue
+
+            for record in records:
+                record['listener'] = backend.address
+                tenants.append(record)
+
+        return json.dumps(tenants)
+
+    def capacity(self):
+        """ Returns the last capacity report of every backend """
+        return json.dumps(dict((backend.address, backend.capacity)
+                               for backend in self.backends.values()))
+
+
+# Handler and Server classes
+class CoordinatorHandler(SocketServer.BaseRequestHandler):
+    """ Handles navlistener protocol requests on behalf of the backends """
+
+    def handle(self):
+        """ Override default handler """
+        recv_dict = json.loads(recv_json(self.request))
+
+        text = '%s wrote action: %s' % (self.client_address[0], recv_dict.get('action'))
+        logging.info(text)
+
+        coordinator = self.server.coordinator
+
+        if recv_dict['action'] == 'start':
+            response = coordinator.start(recv_dict)
+        elif recv_dict['action'] == 'batch':
+            response = coordinator.batch(recv_dict)
+        elif recv_dict['action'] == 'stop':
+            response = coordinator.stop(recv_dict)
+        elif recv_dict['action'] == 'status':
+            response = coordinator.status(recv_dict)
+        elif recv_dict['action'] == 'list':
+            response = coordinator.list()
+        elif recv_dict['action'] == 'capacity':
+            response = coordinator.capacity()
+        else:
+            logging.error('Did not receive supported action')
+            response = 'Did not receive support action'
+
+        self.request.sendall(response)
+
+
+class ThreadingCoordinatorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """ TCP server that threads work, so placement state is shared """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass, coordinator):
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
+        self.coordinator = coordinator
+
+
+def main():
+    """ Main function """
+    if len(sys.argv) < 4:
+        logging.error('Usage: python coordinator.py IP PORT BACKEND_IP:PORT [BACKEND_IP:PORT ...]')
+        sys.exit(1)
+    else:
+        host = sys.argv[1]
+        port = int(sys.argv[2])
+        backends = sys.argv[3:]
+
+    coordinator = Coordinator(backends)
+
+    poller = threading.Thread(target=coordinator.poll)
+    poller.daemon = True
+    poller.start()
+
+    text = 'Starting coordinator on: %s:%d for %s' % (host, port, ', '.join(backends))
+    logging.info(text)
+
+    server = ThreadingCoordinatorServer((host, port), CoordinatorHandler, coordinator)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
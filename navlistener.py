@@ -2,58 +2,93 @@
 
 import os
 import sys
+import glob
+import socket
 import SocketServer
+import multiprocessing
 import json
 import logging
 from time import sleep
 
 # pylint: disable=W0403
 import containers
+import ports
+import prereqs
+import statuscache
 # Import submodules
 from navlib import navlib
 from pyutils import utils, loggerinitializer
 
 # Globals
 LOG_PATH = '/var/log/murron'
-try:
-    os.mkdir(LOG_PATH)
-except OSError:
-    # Dir already exists
-    pass
+prereqs.ensure_dir(LOG_PATH)
 
 LISTENER_LOG = os.path.join(LOG_PATH, 'navlistener.log')
 loggerinitializer.initialize_logger(LISTENER_LOG)
 NAV_LOG = os.path.join(LOG_PATH, 'nav.log')
 NUM_LOOPS = 20
+DISK_PATH = '/dmcrypt'
+MACHINE_ID = '/etc/machine-id'
 
 
 # Global functions
+def check_storage_driver(data_dict):
+    """ Returns an error response if the requested storage driver is not
+        supported, None if the start can go ahead """
+    storage_driver = data_dict.get('storage_driver')
+    if storage_driver is None or storage_driver in containers.STORAGE_DRIVERS:
+        return None
+
+    text = 'Unsupported storage driver: %s' % storage_driver
+    logging.error(text)
+    return text
+
+
 def setup_vnc(rand_int, navpass, navlog, data_dict):
     """ Does the setup and starting of the VNC container """
     vncpass = data_dict['vncpass']
 
+    error = check_storage_driver(data_dict)
+    if error is not None:
+        return error
+
     logging.info('Initializing DockerVNC instance')
-    vnc = containers.DockerVNC(rand_int, navpass, navlog, vncpass)
+    try:
+        vnc = containers.DockerVNC(rand_int, navpass, navlog, vncpass,
+                                   data_dict.get('storage_driver'))
+    except SystemExit:
+        # Setup already logged why; give back what was reserved
+        ports.release_tenant(rand_int)
+        return 'VNC setup failed'
 
     logging.info('Starting dockerd')
-    utils.start_enable_service(vnc.docker_service_name)
+    containers.start_dservice(vnc.docker_service_name)
     sleep(5) # Wait for dockerd to start
 
+    logging.info('Opening firewall port')
+    utils.set_firewall(vnc.port)
+
     logging.info('Starting VNC container')
     port = vnc.run()
-    text = 'VNC container started on port: %s' % str(port)
-    logging.info(text)
-
-    logging.info('Opening firewall port')
-    utils.set_firewall(port)
+    if port is None:
+        logging.error('VNC container failed to start')
+    else:
+        text = 'VNC container started on port: %s' % str(port)
+        logging.info(text)
 
     data = {'container': 'docker-vnc', 'docker': vnc.docker,
             'dservice': vnc.docker_service_name, 'device': vnc.device,
             'docker_lib': vnc.docker_lib, 'docker_run': vnc.docker_run,
             'mount_point': vnc.mount, 'dockerd': vnc.dockerd,
             'docker_bridge': vnc.bridge, 'category': vnc.category,
-            'port': port, 'loop_file': vnc.loop_file,
-            'dservice_path': vnc.docker_service_full_path}
+            'port': vnc.port, 'loop_file': vnc.loop_file,
+            'dservice_path': vnc.docker_service_env,
+            'storage_driver': vnc.storage_driver}
+
+    if port is None:
+        logging.info('Cleaning up failed VNC setup')
+        cleanup(navpass, navlog, data)
+        return 'VNC container failed to start'
 
     return json.dumps(data)
 
@@ -66,29 +101,48 @@ def setup_jabber(rand_int, navpass, navlog, data_dict):
     user2 = data_dict['user2']
     pass2 = data_dict['pass2']
 
+    error = check_storage_driver(data_dict)
+    if error is not None:
+        return error
+
     logging.info('Initializing DockerJabber instance')
-    jabber = containers.DockerJabber(rand_int, navpass, navlog, jabber_ip,
-                                     user1, pass1, user2, pass2)
+    try:
+        jabber = containers.DockerJabber(rand_int, navpass, navlog, jabber_ip,
+                                         user1, pass1, user2, pass2,
+                                         data_dict.get('storage_driver'))
+    except SystemExit:
+        # Setup already logged why; give back what was reserved
+        ports.release_tenant(rand_int)
+        return 'Jabber setup failed'
 
     logging.info('Starting dockerd')
-    utils.start_enable_service(jabber.docker_service_name)
+    containers.start_dservice(jabber.docker_service_name)
     sleep(5) # Wait for dockerd to start
 
+    logging.info('Opening firewall port')
+    utils.set_firewall(jabber.port)
+
     logging.info('Starting jabber container')
     port = jabber.run()
-    text = 'Jabber Container started on port: %s' % str(port)
-    logging.info(text)
-
-    logging.info('Opening firewall port')
-    utils.set_firewall(port)
+    if port is None:
+        logging.error('Jabber container failed to start')
+    else:
+        text = 'Jabber Container started on port: %s' % str(port)
+        logging.info(text)
 
     data = {'container': 'docker-jabber', 'docker': jabber.docker,
             'dservice': jabber.docker_service_name, 'device': jabber.device,
             'docker_lib': jabber.docker_lib, 'docker_run': jabber.docker_run,
             'mount_point': jabber.mount, 'dockerd': jabber.dockerd,
             'docker_bridge': jabber.bridge, 'category': jabber.category,
-            'port': port, 'loop_file': jabber.loop_file,
-            'dservice_path': jabber.docker_service_full_path}
+            'port': jabber.port, 'loop_file': jabber.loop_file,
+            'dservice_path': jabber.docker_service_env,
+            'storage_driver': jabber.storage_driver}
+
+    if port is None:
+        logging.info('Cleaning up failed Jabber setup')
+        cleanup(navpass, navlog, data)
+        return 'Jabber container failed to start'
 
     return json.dumps(data)
 
@@ -101,10 +155,15 @@ def cleanup(passwd, navlog, data_dict):
     logging.info('container stopped')
 
     # Stop and disable the service
-    utils.stop_disable_service(data_dict['dservice'].split('.')[0])
-    logging.info('service disabled')
+    containers.stop_dservice(data_dict['dservice'].split('.')[0])
+    logging.info('service stopped')
 
-    # Remove service
+    # Records without a driver predate it being configurable
+    containers.cleanup_storage(data_dict['docker_lib'],
+                               data_dict.get('storage_driver', 'devicemapper'))
+    logging.info('storage driver cleaned up')
+
+    # Remove service env file (or legacy unit file)
     cmdlist = ['rm', '-rf', data_dict['dservice_path']]
     utils.simple_popen(cmdlist)
     logging.info('service removed')
@@ -150,11 +209,72 @@ def cleanup(passwd, navlog, data_dict):
     logging.info('bridge deleted')
 
     utils.remove_firewall(data_dict['port'])
+    ports.release(data_dict['port'])
     logging.info('Port removed')
 
     return 'Cleanup complete'
 
 
+def mark_inflight(inflight_path, rand_int):
+    """ Marks a start as in progress on this listener """
+    prereqs.ensure_dir(inflight_path)
+    open(os.path.join(inflight_path, str(rand_int)), 'w').close()
+
+
+def unmark_inflight(inflight_path, rand_int):
+    """ Clears the in progress marker of a start """
+    try:
+        os.remove(os.path.join(inflight_path, str(rand_int)))
+    except OSError:
+        pass
+
+
+def host_id():
+    """ Identifies the host, so a coordinator can tell listeners sharing
+        one host (and its bridges, loops, disk and ports) apart """
+    try:
+        with open(MACHINE_ID, 'r') as machine_id:
+            return machine_id.read().strip()
+    except IOError:
+        return socket.gethostname()
+
+
+def capacity(inflight_path):
+    """ Returns a capacity report for placement by a coordinator. Free
+        resources are host-wide and already net of in-flight starts """
+    used_ips = containers.used_bridge_ips()
+    free_bridges = len([ip for ip in containers.BRIDGE_IPS if ip not in used_ips])
+
+    # pylint: disable=W0612
+    output, errors = utils.simple_popen(['losetup', '-a'])
+    used_loops = len(output.splitlines())
+    all_loops = len([dev for dev in glob.glob('/dev/loop*') if dev[9:].isdigit()])
+
+    # Only created by the first tenant otherwise
+    prereqs.ensure_dir(DISK_PATH)
+    disk = os.statvfs(DISK_PATH)
+    disk_free_mb = disk.f_bavail * disk.f_frsize / (1024 * 1024)
+
+    try:
+        inflight = os.listdir(inflight_path)
+    except OSError:
+        inflight = []
+
+    ports.sweep(containers.tenant_exists)
+    num_ports = ports.PORT_RANGE[1] - ports.PORT_RANGE[0] + 1
+    free_ports = num_ports - len(ports.read_reservations())
+
+    data = {'host_id': host_id(),
+            'free_bridges': free_bridges, 'free_loops': all_loops - used_loops,
+            'tenant_loops': containers.DRIVER_LOOPS,
+            'default_driver': containers.ContainerBase.STORAGE_DRIVER,
+            'disk_free_mb': disk_free_mb, 'tenant_disk_mb': containers.LOOP_SIZE_MB,
+            'free_ports': free_ports, 'inflight': inflight,
+            'tenants': len(glob.glob(containers.env_file_path('*')))}
+
+    return json.dumps(data)
+
+
 # Handler and Server classes
 class TCPHandler(SocketServer.BaseRequestHandler):
     """ Handles the creation of the docker daemon and container """
@@ -168,24 +288,44 @@ class TCPHandler(SocketServer.BaseRequestHandler):
         logging.info(text)
 
         if recv_dict['action'] == 'start':
-            if recv_dict['image'] == 'wallace123/docker-vnc':
-                logging.info('Starting VNC image')
-                response = setup_vnc(recv_dict['rand_int'], self.server.navpass,
-                                     self.server.navlog, recv_dict)
-            elif recv_dict['image'] == 'wallace123/docker-jabber':
-                logging.info('Starting Jabber image')
-                response = setup_jabber(recv_dict['rand_int'], self.server.navpass,
-                                        self.server.navlog, recv_dict)
-            else:
-                logging.error('Did not receive supported image')
+            mark_inflight(self.server.inflight_path, recv_dict['rand_int'])
+            try:
+                if recv_dict['image'] == 'wallace123/docker-vnc':
+                    logging.info('Starting VNC image')
+                    response = setup_vnc(recv_dict['rand_int'], self.server.navpass,
+                                         self.server.navlog, recv_dict)
+                elif recv_dict['image'] == 'wallace123/docker-jabber':
+                    logging.info('Starting Jabber image')
+                    response = setup_jabber(recv_dict['rand_int'], self.server.navpass,
+                                            self.server.navlog, recv_dict)
+                else:
+                    logging.error('Did not receive supported image')
+                    response = 'Did not receive supported image'
+            finally:
+                unmark_inflight(self.server.inflight_path, recv_dict['rand_int'])
         elif recv_dict['action'] == 'stop':
             logging.info('Starting cleanup actions')
             response = cleanup(self.server.navpass, self.server.navlog, recv_dict)
+        elif recv_dict['action'] in ['list', 'status']:
+            status = statuscache.query(self.server.status_socket, recv_dict)
+            if isinstance(status, dict) and 'error' in status:
+                response = status['error']
+            elif status is None:
+                response = 'Unknown tenant: %s' % recv_dict['rand_int']
+            else:
+                response = json.dumps(status)
+        elif recv_dict['action'] == 'capacity':
+            try:
+                response = capacity(self.server.inflight_path)
+            # pylint: disable=W0703
+            except Exception:
+                logging.exception('Capacity report failed')
+                response = 'Capacity report failed'
         else:
             logging.error('Did not receive supported action')
             response = 'Did not receive support action'
 
-        self.request.send(response)
+        self.request.sendall(response)
 
 
 class ForkingNavServer(SocketServer.ForkingMixIn, SocketServer.TCPServer):
@@ -194,6 +334,47 @@ class ForkingNavServer(SocketServer.ForkingMixIn, SocketServer.TCPServer):
         SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
         self.navpass = navpass
         self.navlog = navlog
+        self.cache_process = None
+        # Per listener, so several listeners can share a host
+        self.inflight_path = os.path.join(prereqs.STATE_PATH,
+                                          'inflight-%d' % self.server_address[1])
+        self.status_socket = statuscache.socket_path(self.server_address[1])
+
+    def run_status_cache(self):
+        """ Body of the status cache process """
+        # Do not keep the listening port open if the listener goes away
+        self.socket.close()
+        statuscache.serve(self.status_socket)
+
+    def start_status_cache(self):
+        """ Follows tenant state for list and status actions in its own
+            process, so this process stays free of threads when it forks """
+        self.cache_process = multiprocessing.Process(target=self.run_status_cache)
+        self.cache_process.daemon = True
+        self.cache_process.start()
+
+    def status_cache_alive(self):
+        """ True if the status cache process is still running """
+        if not self.cache_process.is_alive():
+            return False
+
+        # collect_children may have reaped it behind multiprocessing's back
+        try:
+            os.kill(self.cache_process.pid, 0)
+        except OSError:
+            return False
+
+        return True
+
+    def process_request(self, request, client_address):
+        """ Restarts the status cache if it died, then forks the handler """
+        if not self.status_cache_alive():
+            text = 'Status cache process %d exited (%s), restarting' % \
+                   (self.cache_process.pid, self.cache_process.exitcode)
+            logging.error(text)
+            self.start_status_cache()
+
+        SocketServer.ForkingMixIn.process_request(self, request, client_address)
 
 
 def main():
@@ -217,12 +398,7 @@ def main():
 
     # Run prereqs
     logging.info('Running prereqs')
-    utils.create_loop_devices(NUM_LOOPS)
-    text = 'Created %d loop devices' % NUM_LOOPS
-    logging.info(text)
-
-    logging.info('Setting firewall to masquerade on public zone')
-    utils.set_masquerade()
+    prereqs.ensure_prereqs(NUM_LOOPS)
     logging.info('Prereqs complete')
 
     # Start listener
@@ -230,6 +406,7 @@ def main():
     logging.info(text)
 
     server = ForkingNavServer((host, port), TCPHandler, navpass, navlog)
+    server.start_status_cache()
     server.serve_forever()
 
 if __name__ == '__main__':
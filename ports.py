@@ -0,0 +1,146 @@
+""" Module which reserves host ports for tenant containers """
+
+import os
+import json
+import time
+import fcntl
+import socket
+import logging
+
+# Import submodules
+# pylint: disable=W0403
+import prereqs
+
+# Globals
+STATE_PATH = '/var/lib/murron'
+PORTS_FILE = os.path.join(STATE_PATH, 'ports.json')
+LOCK_FILE = os.path.join(STATE_PATH, 'ports.lock')
+PORT_RANGE = (32000, 32999)
+STALE_AGE = 3600  # Seconds a reservation may exist before its tenant does
+
+
+class PortLock(object):
+    """ Exclusive lock on the reservations file, shared across forked
+        listener workers """
+    def __init__(self):
+        self.lock_file = None
+
+    def __enter__(self):
+        prereqs.ensure_dir(STATE_PATH)
+        self.lock_file = open(LOCK_FILE, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def read_reservations():
+    """ Returns the reservations dictionary of port string to a
+        dictionary with the tenant and the time it was reserved """
+    try:
+        with open(PORTS_FILE, 'r') as ports_file:
+            reservations = json.load(ports_file)
+    except (IOError, ValueError):
+        return {}
+
+    for port, owner in reservations.items():
+        if not isinstance(owner, dict):
+            # Reserved before times were recorded
+            reservations[port] = {'tenant': owner, 'time': 0}
+
+    return reservations
+
+
+def write_reservations(reservations):
+    """ Writes the reservations dictionary """
+    tmp_file = PORTS_FILE + '.tmp'
+    with open(tmp_file, 'w') as ports_file:
+        json.dump(reservations, ports_file)
+    os.rename(tmp_file, PORTS_FILE)
+
+
+def port_is_free(port):
+    """ True if nothing on the host is bound to the port """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('0.0.0.0', port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def reserve(tenant, port_range=PORT_RANGE):
+    """ Reserves a host port for the tenant, returns the port or None
+        if the range is exhausted """
+    with PortLock():
+        reservations = read_reservations()
+
+        for port, owner in reservations.items():
+            if owner['tenant'] == str(tenant):
+                return int(port)
+
+        for port in range(port_range[0], port_range[1] + 1):
+            if str(port) not in reservations and port_is_free(port):
+                reservations[str(port)] = {'tenant': str(tenant), 'time': time.time()}
+                write_reservations(reservations)
+                text = 'Reserved port %d for %s' % (port, tenant)
+                logging.info(text)
+                return port
+
+    text = 'No free ports left in range %d-%d' % port_range
+    logging.error(text)
+    return None
+
+
+def release(port):
+    """ Releases a reserved host port """
+    with PortLock():
+        reservations = read_reservations()
+
+        if reservations.pop(str(port), None) is None:
+            text = 'Port %s was not reserved' % port
+            logging.info(text)
+            return
+
+        write_reservations(reservations)
+        text = 'Released port %s' % port
+        logging.info(text)
+
+
+def release_tenant(tenant):
+    """ Releases the host port reserved for a tenant, if any """
+    port = lookup(tenant)
+    if port is not None:
+        release(port)
+
+
+def lookup(tenant):
+    """ Returns the host port reserved for a tenant, None if there is none """
+    for port, owner in read_reservations().items():
+        if owner['tenant'] == str(tenant):
+            return int(port)
+
+    return None
+
+
+def sweep(alive):
+    """ Releases reservations older than STALE_AGE whose tenant is not
+        alive, e.g. left behind by a start that died part way """
+    with PortLock():
+        reservations = read_reservations()
+        now = time.time()
+
+        stale = [port for port, owner in reservations.items()
+                 if now - owner['time'] > STALE_AGE and not alive(owner['tenant'])]
+        if not stale:
+            return
+
+        for port in stale:
+            text = 'Released stale port %s of %s' % (port, reservations.pop(port)['tenant'])
+            logging.info(text)
+        write_reservations(reservations)
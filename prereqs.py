@@ -0,0 +1,131 @@
+""" Module which checks and applies host prerequisites only when needed """
+
+import os
+import json
+import time
+import filecmp
+import shutil
+import logging
+
+# Import submodules
+# pylint: disable=W0403
+from pyutils import utils
+
+# Globals
+STATE_PATH = '/var/run/murron'
+STAMP_FILE = os.path.join(STATE_PATH, 'prereqs.json')
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+STAMP_MAX_AGE = 3600  # Seconds before the stamp is re-verified against the host
+UNIT_NAME = 'murron-docker@.service'
+UNIT_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), UNIT_NAME)
+UNIT_DEST = os.path.join('/etc/systemd/system', UNIT_NAME)
+
+
+def ensure_dir(path):
+    """ Creates a directory if it does not already exist """
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Dir created in the meantime
+            pass
+
+
+def get_boot_id():
+    """ Returns the kernel boot id, changes on every reboot """
+    try:
+        with open(BOOT_ID, 'r') as boot_file:
+            return boot_file.read().strip()
+    except IOError:
+        return None
+
+
+def read_stamp():
+    """ Returns the host-state stamp dictionary, empty if there is none """
+    try:
+        with open(STAMP_FILE, 'r') as stamp_file:
+            return json.load(stamp_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_stamp(stamp):
+    """ Writes the host-state stamp """
+    ensure_dir(STATE_PATH)
+    tmp_file = STAMP_FILE + '.tmp'
+    with open(tmp_file, 'w') as stamp_file:
+        json.dump(stamp, stamp_file)
+    os.rename(tmp_file, STAMP_FILE)
+
+
+def stamp_is_fresh(stamp, num_loops):
+    """ True if the stamp was written this boot, recently, for enough loops """
+    if not stamp or stamp.get('boot_id') != get_boot_id():
+        return False
+
+    if stamp.get('num_loops', 0) < num_loops:
+        return False
+
+    return time.time() - stamp.get('time', 0) < STAMP_MAX_AGE
+
+
+def loop_devices_present(num_loops):
+    """ True if /dev/loop0 through /dev/loop<num_loops-1> all exist """
+    for num in range(num_loops):
+        if not os.path.exists('/dev/loop%d' % num):
+            return False
+
+    return True
+
+
+def masquerade_enabled():
+    """ True if masquerade is already on for the public zone """
+    cmdlist = ['firewall-cmd', '--zone=public', '--query-masquerade']
+    # pylint: disable=W0612
+    output, errors = utils.simple_popen(cmdlist)
+
+    return output.strip() == 'yes'
+
+
+def unit_template_installed():
+    """ True if the installed murron-docker@ template matches this checkout """
+    return os.path.exists(UNIT_DEST) and filecmp.cmp(UNIT_SRC, UNIT_DEST, shallow=False)
+
+
+def ensure_unit_template():
+    """ Installs the murron-docker@ template unit, reloading systemd only
+        when the template was missing or changed """
+    if unit_template_installed():
+        return
+
+    shutil.copyfile(UNIT_SRC, UNIT_DEST)
+    utils.simple_popen(['systemctl', 'daemon-reload'])
+    text = 'Installed systemd template unit: %s' % UNIT_DEST
+    logging.info(text)
+
+
+def ensure_prereqs(num_loops):
+    """ Creates loop devices, sets masquerade and installs the template
+        unit only if they are missing or the host-state stamp is stale """
+    ensure_unit_template()
+    stamp = read_stamp()
+
+    if stamp_is_fresh(stamp, num_loops) and loop_devices_present(num_loops):
+        logging.info('Prereqs stamp is fresh, skipping')
+        return
+
+    if loop_devices_present(num_loops):
+        text = '%d loop devices already present' % num_loops
+        logging.info(text)
+    else:
+        utils.create_loop_devices(num_loops)
+        text = 'Created %d loop devices' % num_loops
+        logging.info(text)
+
+    if masquerade_enabled():
+        logging.info('Masquerade already set on public zone')
+    else:
+        logging.info('Setting firewall to masquerade on public zone')
+        utils.set_masquerade()
+
+    write_stamp({'boot_id': get_boot_id(), 'num_loops': num_loops, 'time': time.time()})
@@ -0,0 +1,326 @@
+""" Module which keeps an in-memory status of every tenant, updated from
+    systemd journal events and each tenant's docker events stream.
+
+    The cache runs in its own process and answers over a unix socket, so
+    the forking listener never forks while cache threads hold locks. """
+
+import os
+import json
+import time
+import socket
+import calendar
+import logging
+import threading
+import subprocess
+import SocketServer
+
+# Import submodules
+# pylint: disable=W0403
+import containers
+import ports
+import prereqs
+from pyutils import utils
+
+# Globals
+UNIT_PREFIX = '%s@' % containers.DSERVICE_TEMPLATE
+JOURNAL_CMD = ['journalctl', '-f', '-n', '0', '-o', 'json', '_PID=1']
+# systemd catalog message ids for unit started, stopped and failed
+MESSAGE_STATES = {'39f53479d3a045ac8e11786248231fbf': 'active',
+                  '9d1aaa27d60140bd96365438aad20286': 'inactive',
+                  'be02cf6855d2428ba40df7e9d022f03d': 'failed'}
+RECV_SIZE = 4096
+DOCKER_STATES = {'create': 'created', 'start': 'running', 'unpause': 'running',
+                 'pause': 'paused', 'die': 'exited', 'destroy': 'removed'}
+
+
+def read_env(env_file):
+    """ Returns the murron-docker@ env file as a dictionary """
+    env = {}
+    try:
+        with open(env_file, 'r') as env_input:
+            for line in env_input:
+                if '=' in line:
+                    key, value = line.strip().split('=', 1)
+                    env[key] = value
+    except IOError:
+        pass
+
+    return env
+
+
+def parse_docker_time(timestamp):
+    """ Converts docker's RFC3339 timestamps to epoch seconds """
+    try:
+        return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+class StatusCache(object):
+    """ Tenant status keyed by tenant id (the murron-docker@ instance).
+
+        Writers replace whole records under a lock, so readers can copy
+        references without taking it. """
+    def __init__(self):
+        self.tenants = {}
+        self.watching = set()
+        self.lock = threading.Lock()
+
+    def update(self, tenant, **fields):
+        """ Replaces the tenant record with one carrying the new fields """
+        with self.lock:
+            if tenant in self.tenants:
+                record = dict(self.tenants[tenant])
+            else:
+                record = self.new_record(tenant)
+            record.update(fields)
+            self.tenants[tenant] = record
+
+    @staticmethod
+    def new_record(tenant):
+        """ Returns a record for a tenant seen for the first time """
+        env = read_env(containers.env_file_path(tenant))
+        port = ports.lookup(tenant)
+
+        return {'tenant': tenant, 'dservice': UNIT_PREFIX + tenant,
+                'socket': env.get('SOCKET'), 'bridge': env.get('BRIDGE'),
+                'port': port, 'daemon': 'unknown', 'daemon_since': None,
+                'container': None, 'container_state': 'unknown',
+                'container_since': None}
+
+    @staticmethod
+    def removed(record):
+        """ True if the tenant was cleaned up (daemon down, env file gone) """
+        return record['daemon'] != 'active' and \
+            not containers.tenant_exists(record['tenant'])
+
+    @staticmethod
+    def present(record):
+        """ Returns the record as sent to clients, with uptime filled in """
+        data = dict(record)
+        if data['container_state'] == 'running' and data['container_since']:
+            data['uptime'] = int(time.time() - data['container_since'])
+        else:
+            data['uptime'] = None
+
+        return data
+
+    def status(self, tenant):
+        """ Returns the status of one tenant, None if it is unknown """
+        record = self.tenants.get(str(tenant))
+        if record is None or self.removed(record):
+            return None
+
+        return self.present(record)
+
+    def list(self):
+        """ Returns the status of every tenant """
+        return [self.present(record) for record in self.tenants.values()
+                if not self.removed(record)]
+
+    def start(self):
+        """ Loads existing tenants and starts following events """
+        thread = threading.Thread(target=self.follow_journal)
+        thread.daemon = True
+        thread.start()
+
+        if os.path.isdir(containers.ENV_PATH):
+            for env_file in os.listdir(containers.ENV_PATH):
+                if env_file.startswith('docker-') and env_file.endswith('.env'):
+                    tenant = env_file[len('docker-'):-len('.env')]
+                    thread = threading.Thread(target=self.sync_tenant, args=(tenant,))
+                    thread.daemon = True
+                    thread.start()
+
+    def sync_tenant(self, tenant):
+        """ One-off read of the daemon state for a tenant found at startup """
+        cmdlist = ['systemctl', 'show', '-p', 'ActiveState',
+                   '-p', 'ActiveEnterTimestampMonotonic', UNIT_PREFIX + tenant]
+        # pylint: disable=W0612
+        output, errors = utils.simple_popen(cmdlist)
+        props = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+
+        since = None
+        if props.get('ActiveEnterTimestampMonotonic', '0') != '0':
+            with open('/proc/uptime', 'r') as uptime_file:
+                uptime = float(uptime_file.read().split()[0])
+            since = time.time() - uptime + int(props['ActiveEnterTimestampMonotonic']) / 1e6
+
+        self.set_daemon_state(tenant, props.get('ActiveState', 'unknown'), since)
+
+    def set_daemon_state(self, tenant, state, since):
+        """ Records a daemon state change and follows docker events once
+            the daemon is active """
+        if state == 'active':
+            self.update(tenant, daemon=state, daemon_since=since)
+            with self.lock:
+                if tenant in self.watching:
+                    return
+                self.watching.add(tenant)
+            thread = threading.Thread(target=self.follow_docker, args=(tenant,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.update(tenant, daemon=state, daemon_since=None,
+                        container_state='exited', container_since=None)
+
+    def follow_journal(self):
+        """ Follows systemd's journal for murron-docker@ state changes """
+        proc = subprocess.Popen(JOURNAL_CMD, stdout=subprocess.PIPE)
+
+        for line in iter(proc.stdout.readline, ''):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+
+            unit = entry.get('UNIT', '')
+            if not unit.startswith(UNIT_PREFIX):
+                continue
+            tenant = unit[len(UNIT_PREFIX):].split('.')[0]
+
+            state = MESSAGE_STATES.get(entry.get('MESSAGE_ID'))
+            if entry.get('JOB_RESULT') == 'failed':
+                state = 'failed'
+            elif entry.get('JOB_RESULT') == 'done':
+                state = {'start': 'active', 'stop': 'inactive'}.get(entry.get('JOB_TYPE'),
+                                                                     state)
+            if state is None:
+                continue
+
+            since = int(entry.get('__REALTIME_TIMESTAMP', 0)) / 1e6 or time.time()
+            text = 'Tenant %s daemon %s' % (tenant, state)
+            logging.info(text)
+            self.set_daemon_state(tenant, state, since)
+
+        logging.error('journalctl exited, daemon states will no longer update')
+
+    def follow_docker(self, tenant):
+        """ Follows the docker events stream on the tenant's daemon socket
+            until the daemon goes away """
+        sock = self.tenants[tenant]['socket'] or \
+            read_env(containers.env_file_path(tenant)).get('SOCKET')
+        if sock is None:
+            text = 'No docker socket known for tenant %s' % tenant
+            logging.error(text)
+            with self.lock:
+                self.watching.discard(tenant)
+            return
+
+        docker = ['/usr/bin/docker', '-H', 'unix://%s' % sock]
+        proc = subprocess.Popen(docker + ['events', '--filter', 'type=container',
+                                          '--format', '{{json .}}'],
+                                stdout=subprocess.PIPE)
+
+        # Containers started before the stream was opened
+        # pylint: disable=W0612
+        output, errors = utils.simple_popen(docker + ['ps', '-a', '--format', '{{.Names}}'])
+        for name in output.split():
+            output, errors = utils.simple_popen(docker + ['inspect', '-f',
+                                                          '{{.State.Status}} '
+                                                          '{{.State.StartedAt}}', name])
+            if len(output.split()) == 2:
+                state, started = output.split()
+                self.update(tenant, container=name, container_state=state,
+                            container_since=parse_docker_time(started))
+
+        for line in iter(proc.stdout.readline, ''):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+
+            state = DOCKER_STATES.get(event.get('Action'))
+            if state is None:
+                continue
+
+            name = event.get('Actor', {}).get('Attributes', {}).get('name')
+            since = event.get('time') if state == 'running' else None
+            self.update(tenant, container=name, container_state=state,
+                        container_since=since)
+
+        proc.wait()
+        with self.lock:
+            self.watching.discard(tenant)
+
+
+# Handler and Server classes
+class StatusHandler(SocketServer.BaseRequestHandler):
+    """ Answers list and status queries from the cache """
+
+    def handle(self):
+        """ Override default handler, always answers with JSON """
+        try:
+            data = self.answer(json.loads(self.request.recv(RECV_SIZE)))
+        # pylint: disable=W0703
+        except Exception:
+            logging.exception('Status cache failed to answer')
+            data = {'error': 'Status cache failed to answer'}
+
+        self.request.sendall(json.dumps(data))
+
+    def answer(self, recv_dict):
+        """ Returns the list, a tenant's status, None for an unknown
+            tenant, or an error dictionary """
+        status_cache = self.server.status_cache
+
+        if recv_dict.get('action') == 'list':
+            return status_cache.list()
+        elif recv_dict.get('action') == 'status':
+            if 'rand_int' not in recv_dict:
+                return {'error': 'status needs rand_int'}
+            return status_cache.status(recv_dict['rand_int'])
+
+        logging.error('Status cache did not receive supported action')
+        return {'error': 'Did not receive supported action'}
+
+
+class ThreadingStatusServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Unix socket server in front of the status cache """
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass, status_cache):
+        SocketServer.UnixStreamServer.__init__(self, server_address, RequestHandlerClass)
+        self.status_cache = status_cache
+
+
+# Global functions
+def socket_path(port):
+    """ Returns the status cache socket of the listener on port """
+    return os.path.join(prereqs.STATE_PATH, 'status-%d.sock' % port)
+
+
+def serve(status_socket):
+    """ Runs the status cache and its unix socket until killed """
+    prereqs.ensure_dir(prereqs.STATE_PATH)
+    if os.path.exists(status_socket):
+        os.remove(status_socket)
+
+    status_cache = StatusCache()
+    status_cache.start()
+
+    text = 'Status cache listening on: %s' % status_socket
+    logging.info(text)
+
+    server = ThreadingStatusServer(status_socket, StatusHandler, status_cache)
+    server.serve_forever()
+
+
+def query(status_socket, data_dict):
+    """ Sends a list or status query to the status cache process, returns
+        the decoded answer, or an error dictionary if it is not answering """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(status_socket)
+        sock.sendall(json.dumps(data_dict))
+        data = ''
+        chunk = sock.recv(RECV_SIZE)
+        while chunk:
+            data += chunk
+            chunk = sock.recv(RECV_SIZE)
+        return json.loads(data)
+    except (socket.error, ValueError):
+        logging.error('Status cache is not answering')
+        return {'error': 'Status cache unavailable'}
+    finally:
+        sock.close()
@@ -0,0 +1,165 @@
+""" Drives coordinator placement against several local stub listeners
+
+    Run with: python -m unittest test_coordinator
+"""
+
+import json
+import time
+import threading
+import unittest
+import SocketServer
+
+# pylint: disable=W0403
+import coordinator
+
+
+class StubHandler(SocketServer.BaseRequestHandler):
+    """ Answers the navlistener protocol from the stub's settings """
+
+    def handle(self):
+        """ Override default handler """
+        recv_dict = json.loads(self.request.recv(4096))
+        stub = self.server.stub
+
+        if recv_dict['action'] == 'capacity':
+            response = json.dumps(stub.report)
+        elif recv_dict['action'] == 'start':
+            time.sleep(stub.start_delay)
+            stub.started.append(recv_dict['rand_int'])
+            response = json.dumps({'dservice': 'murron-docker@%s' % recv_dict['rand_int'],
+                                   'port': stub.address})
+        else:
+            response = 'Unknown tenant: %s' % recv_dict.get('rand_int')
+
+        self.request.sendall(response)
+
+
+class StubServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """ Threaded TCP server for one stub listener """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubListener(object):
+    """ A fake navlistener on a free local port """
+    def __init__(self, host_id='host-a', start_delay=0, **report):
+        self.report = {'host_id': host_id, 'free_bridges': 8, 'free_loops': 20,
+                       'tenant_loops': {'overlay2': 1, 'vfs': 1, 'devicemapper': 3},
+                       'default_driver': 'overlay2', 'disk_free_mb': 100000,
+                       'tenant_disk_mb': 2048, 'free_ports': 1000,
+                       'inflight': [], 'tenants': 0}
+        self.report.update(report)
+        self.start_delay = start_delay
+        self.started = []
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.stub = self
+        self.address = '127.0.0.1:%d' % self.server.server_address[1]
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """ Shuts the stub down """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CoordinatorTest(unittest.TestCase):
+    """ Placement, batching and routing across stub listeners """
+
+    def setUp(self):
+        self.stubs = []
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.stop()
+
+    def make_coordinator(self, *stubs):
+        """ Returns a coordinator over the stubs with fresh capacity """
+        self.stubs.extend(stubs)
+        coord = coordinator.Coordinator([stub.address for stub in stubs])
+        for backend in coord.backends.values():
+            backend.refresh()
+        return coord
+
+    @staticmethod
+    def starts(count, **fields):
+        """ Returns count start requests """
+        requests = []
+        for num in range(count):
+            request = {'action': 'start', 'rand_int': num}
+            request.update(fields)
+            requests.append(request)
+        return requests
+
+    def test_batch_spreads_across_hosts(self):
+        stubs = [StubListener(host_id='host-%d' % num) for num in range(3)]
+        coord = self.make_coordinator(*stubs)
+
+        records = json.loads(coord.batch({'requests': self.starts(3)}))
+
+        self.assertEqual(sorted(record['listener'] for record in records),
+                         sorted(stub.address for stub in stubs))
+        for stub in stubs:
+            self.assertEqual(len(stub.started), 1)
+
+    def test_batch_prefers_least_loaded(self):
+        busy = StubListener(host_id='busy', tenants=5)
+        idle = StubListener(host_id='idle')
+        coord = self.make_coordinator(busy, idle)
+
+        json.loads(coord.batch({'requests': self.starts(3)}))
+
+        self.assertEqual(len(idle.started), 3)
+        self.assertEqual(busy.started, [])
+
+    def test_listeners_on_one_host_share_capacity(self):
+        first = StubListener(host_id='shared', free_bridges=1)
+        second = StubListener(host_id='shared', free_bridges=1)
+        coord = self.make_coordinator(first, second)
+
+        responses = json.loads(coord.batch({'requests': self.starts(2)}))
+
+        self.assertEqual(len(first.started) + len(second.started), 1)
+        self.assertIn('No backend has capacity', responses)
+
+    def test_report_inflight_not_counted_twice(self):
+        stub = StubListener(free_bridges=1, inflight=['1', '2'])
+        coord = self.make_coordinator(stub)
+
+        self.assertEqual(coord.place({'rand_int': 3}).address, stub.address)
+
+    def test_devicemapper_needs_three_loops(self):
+        stub = StubListener(free_loops=2)
+        coord = self.make_coordinator(stub)
+
+        self.assertEqual(coord.place({'rand_int': 1, 'storage_driver': 'devicemapper'}),
+                         None)
+        self.assertEqual(coord.place({'rand_int': 2}).address, stub.address)
+
+    def test_pending_start_survives_refresh(self):
+        stub = StubListener(free_bridges=1, start_delay=0.5)
+        coord = self.make_coordinator(stub)
+
+        thread = threading.Thread(target=coord.start, args=({'action': 'start',
+                                                             'rand_int': 1},))
+        thread.start()
+        time.sleep(0.1)
+        coord.backends[stub.address].refresh()
+
+        self.assertEqual(coord.place({'rand_int': 2}), None)
+        thread.join()
+
+    def test_status_with_backend_down(self):
+        stub = StubListener()
+        coord = self.make_coordinator(stub)
+        coord.owners['7'] = stub.address
+        stub.stop()
+        self.stubs.remove(stub)
+
+        self.assertIn('failed status', coord.status({'action': 'status', 'rand_int': 7}))
+
+
+if __name__ == '__main__':
+    unittest.main()